@@ -1,25 +1,37 @@
-import json
+import orjson
 import numpy as np
 from pyvi import ViTokenizer
-from datasets import Dataset, load_metric, load_dataset
+from datasets import Dataset, load_dataset
+from datasets.fingerprint import Hasher
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM, Seq2SeqTrainer, Trainer, TrainingArguments, \
     Seq2SeqTrainingArguments, DataCollatorForSeq2Seq
 from tqdm.notebook import tqdm
 from torch.utils.data import DataLoader
 import torch
 import os
+import gc
+import sys
+import multiprocess
 import evaluate
+import bert_score
 from dataclasses import dataclass
+from functools import lru_cache
 from nltk.translate.bleu_score import sentence_bleu
+from joblib import Parallel, delayed
+from rouge_score import rouge_scorer
 import spacy
 from loguru import logger
 import nltk
 
-nltk.download("wordnet")
-
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-nlp = spacy.load('vi_core_news_lg')
+
+@lru_cache(maxsize=None)
+def load_spacy_tokenizer():
+    # bleu() only reads token.text, so skip the trained components and the vector table.
+    nlp = spacy.load('vi_core_news_lg', exclude=['tok2vec', 'tagger', 'morphologizer', 'parser', 'senter', 'ner',
+                                                 'attribute_ruler', 'lemmatizer', 'vectors'])
+    return nlp.tokenizer
 
 
 @dataclass
@@ -33,89 +45,183 @@ class Config:
     src_len: int = 1024
     seed: int = 42
     num_proc: int = 16
-    per_device_train_batch_size: int = 4
+    format_batch_size: int = 1024
+    per_device_train_batch_size: int = 16
     per_device_eval_batch_size: int = 16
+    per_device_test_batch_size: int = 48
     num_epochs: int = 10
     lr: float = 1e-4
     warmup_ratio: float = 0.05
     weight_decay: float = 0.015
+    torch_compile: bool = True
 
     def __post_init__(self):
         if self.model_name == 'bartpho':
             self.pretrained_model_name_or_path = 'vinai/bartpho-word-base'
+        self.cache_dir = f'{self.checkpoint}/ds_cache/{self.dataset_name}_{self.task}'
 
 
-def formatting_func_qg(example):
-    input_seq: str = ("### Instruction: \n"
-                      f"{example['instruction_qg']}\n\n"
-                      f"### Context: \n"
-                      f"{ViTokenizer.tokenize(example['context'])}\n\n"
-                      f"### Answer: \n"
-                      f"{ViTokenizer.tokenize(example['answer'])}\n\n"
-                      f"\n\n### Response: \n")
+def formatting_func_qg(batch):
+    contexts = [ViTokenizer.tokenize(context) for context in batch['context']]
+    answers = [ViTokenizer.tokenize(answer) for answer in batch['answer']]
+    input_seq: list[str] = [("### Instruction: \n"
+                             f"{instruction}\n\n"
+                             f"### Context: \n"
+                             f"{context}\n\n"
+                             f"### Answer: \n"
+                             f"{answer}\n\n"
+                             f"\n\n### Response: \n")
+                            for instruction, context, answer in zip(batch['instruction_qg'], contexts, answers)]
 
-    output_seq: str = ViTokenizer.tokenize(example['question'])
+    output_seq: list[str] = [ViTokenizer.tokenize(question) for question in batch['question']]
 
     return {"input_seq": input_seq, 'output_seq': output_seq}
 
 
-def formatting_func_ag(example):
-    input_seq: str = ("### Instruction: \n"
-                      f"{example['instruction_ag']}\n\n"
-                      f"### Context: \n"
-                      f"{ViTokenizer.tokenize(example['context'])}\n\n"
-                      f"### Question: \n"
-                      f"{ViTokenizer.tokenize(example['question'])}\n\n"
-                      f"\n\n### Response: \n")
+def formatting_func_ag(batch):
+    contexts = [ViTokenizer.tokenize(context) for context in batch['context']]
+    questions = [ViTokenizer.tokenize(question) for question in batch['question']]
+    input_seq: list[str] = [("### Instruction: \n"
+                             f"{instruction}\n\n"
+                             f"### Context: \n"
+                             f"{context}\n\n"
+                             f"### Question: \n"
+                             f"{question}\n\n"
+                             f"\n\n### Response: \n")
+                            for instruction, context, question in zip(batch['instruction_ag'], contexts, questions)]
 
-    output_seq: str = ViTokenizer.tokenize(example['answer'])
+    output_seq: list[str] = [ViTokenizer.tokenize(answer) for answer in batch['answer']]
 
     return {"input_seq": input_seq, 'output_seq': output_seq}
 
 
+BLEU_WEIGHTS = [(1, 0, 0, 0), (0.5, 0.5, 0, 0), (0.33, 0.33, 0.33, 0), (0.25, 0.25, 0.25, 0.25)]
+ROUGE_TYPES = ['rouge1', 'rouge2', 'rougeL', 'rougeLsum']
+ROUGE_SCORER = rouge_scorer.RougeScorer(ROUGE_TYPES, use_stemmer=False)
+PARALLEL_MIN_PAIRS = 1024
+
+
+def _score_pair(sent1_tokens, sent2_tokens):
+    return sentence_bleu([sent1_tokens], sent2_tokens, weights=BLEU_WEIGHTS)
+
+
 def bleu(predict, goal):
-    bleu_scores = {1: [], 2: [], 3: [], 4: []}
-
-    for sent1, sent2 in zip(predict, goal):
-        sent1_doc = nlp(sent1)
-        sent2_doc = nlp(sent2)
-        ws = [(1, 0, 0, 0), (0.5, 0.5, 0, 0), (0.33, 0.33, 0.33, 0), (0.25, 0.25, 0.25, 0.25)]
-        for n in range(1, 5):
-            weights = ws[n - 1]
-            sent1_tokens = [token.text for token in sent1_doc]
-            sent2_tokens = [token.text for token in sent2_doc]
-            bleu_score = sentence_bleu([sent1_tokens], sent2_tokens, weights=weights)
-            bleu_scores[n].append(bleu_score)
+    # Only token.text is needed, so run the tokenizer alone and score BLEU1-4 in one call per pair.
+    tokenizer = load_spacy_tokenizer()
+    predict_tokens = [[token.text for token in doc] for doc in tokenizer.pipe(predict, batch_size=256)]
+    goal_tokens = [[token.text for token in doc] for doc in tokenizer.pipe(goal, batch_size=256)]
+
+    pairs = zip(predict_tokens, goal_tokens)
+    if len(predict_tokens) >= PARALLEL_MIN_PAIRS:
+        # sentence_bleu is pure Python, so use processes rather than threads to get around the GIL
+        bleu_scores = Parallel(n_jobs=-1, batch_size=64, backend='loky')(
+            delayed(_score_pair)(sent1_tokens, sent2_tokens) for sent1_tokens, sent2_tokens in pairs)
+    else:
+        bleu_scores = [_score_pair(sent1_tokens, sent2_tokens) for sent1_tokens, sent2_tokens in pairs]
+    bleu_scores = np.array(bleu_scores)
     result = {}
     for n in range(1, 5):
-        avg_bleu_score = (sum(bleu_scores[n]) / len(bleu_scores[n])) * 100
-        result["BLEU{}".format(n)] = (sum(bleu_scores[n]) / len(bleu_scores[n])) * 100
+        result["BLEU{}".format(n)] = bleu_scores[:, n - 1].mean() * 100
     return result
 
 
+def _score_rouge_pair(sent1, sent2):
+    return ROUGE_SCORER.score(sent2, sent1)
+
+
+def rouge(predict, goal):
+    pairs = zip(predict, goal)
+    if len(predict) >= PARALLEL_MIN_PAIRS:
+        rouge_scores = Parallel(n_jobs=-1, batch_size=64, backend='loky')(
+            delayed(_score_rouge_pair)(sent1, sent2) for sent1, sent2 in pairs)
+    else:
+        rouge_scores = [_score_rouge_pair(sent1, sent2) for sent1, sent2 in pairs]
+    return [{k: np.mean([score[k].fmeasure for score in rouge_scores]) * 100} for k in ROUGE_TYPES]
+
+
+def ensure_wordnet():
+    # METEOR is the only consumer, so only fetch wordnet when scoring and only if it is missing.
+    # The trailing slash matches both an extracted corpora/wordnet directory and corpora/wordnet.zip.
+    try:
+        nltk.data.find('corpora/wordnet/')
+    except LookupError:
+        nltk.download('wordnet', quiet=True)
+
+
+def cache_file_name(conf: Config, dataset: Dataset, stage: str, key: tuple) -> str:
+    # Name the file after the input split's fingerprint and a hash of what the map depends on, so changing
+    # templates, lengths or the checkpoint writes a new file instead of reloading a stale one.
+    return f'{conf.cache_dir}/{stage}_{dataset._fingerprint}_{Hasher.hash(key)[:16]}.arrow'
+
+
 def prepare_data(conf: Config):
     logger.info('-----:----- Preparing dataset -----:-----')
     data = load_dataset(f'shnl/{conf.dataset_name}', use_auth_token=True)
     train_dataset = data['train']
     dev_dataset = data['validation']
     test_dataset = data['test']
-    if conf.task == 'qg':
-        train_dataset = train_dataset.map(formatting_func_qg, num_proc=conf.num_proc).remove_columns(
-            ['instruction_qg', 'instruction_ag', 'context', 'question', 'answer'])
-        dev_dataset = dev_dataset.map(formatting_func_qg, num_proc=conf.num_proc).remove_columns(
-            ['instruction_qg', 'instruction_ag', 'context', 'question', 'answer'])
-        test_dataset = test_dataset.map(formatting_func_qg, num_proc=conf.num_proc).remove_columns(
-            ['instruction_qg', 'instruction_ag', 'context', 'question', 'answer'])
-    else:
-        train_dataset = train_dataset.map(formatting_func_ag, num_proc=conf.num_proc).remove_columns(
-            ['instruction_qg', 'instruction_ag', 'context', 'question', 'answer'])
-        dev_dataset = dev_dataset.map(formatting_func_ag, num_proc=conf.num_proc).remove_columns(
-            ['instruction_qg', 'instruction_ag', 'context', 'question', 'answer'])
-        test_dataset = test_dataset.map(formatting_func_ag, num_proc=conf.num_proc).remove_columns(
-            ['instruction_qg', 'instruction_ag', 'context', 'question', 'answer'])
+    formatting_func = formatting_func_qg if conf.task == 'qg' else formatting_func_ag
+    os.makedirs(conf.cache_dir, exist_ok=True)
+    columns = ['instruction_qg', 'instruction_ag', 'context', 'question', 'answer']
+    fmt_key = (formatting_func, columns)
+    train_dataset = train_dataset.map(formatting_func, batched=True, batch_size=conf.format_batch_size,
+                                      num_proc=conf.num_proc,
+                                      remove_columns=columns,
+                                      cache_file_name=cache_file_name(conf, train_dataset, 'train_fmt', fmt_key),
+                                      load_from_cache_file=True)
+    dev_dataset = dev_dataset.map(formatting_func, batched=True, batch_size=conf.format_batch_size,
+                                  num_proc=conf.num_proc,
+                                  remove_columns=columns,
+                                  cache_file_name=cache_file_name(conf, dev_dataset, 'validation_fmt', fmt_key),
+                                  load_from_cache_file=True)
+    test_dataset = test_dataset.map(formatting_func, batched=True, batch_size=conf.format_batch_size,
+                                    num_proc=conf.num_proc,
+                                    remove_columns=columns,
+                                    cache_file_name=cache_file_name(conf, test_dataset, 'test_fmt', fmt_key),
+                                    load_from_cache_file=True)
     return train_dataset, dev_dataset, test_dataset
 
 
+class DataPrefetcher:
+    """Copies the next batch to the GPU on a side stream while the current one is generating."""
+
+    def __init__(self, loader: DataLoader, keys: tuple[str, ...] = ('input_ids', 'attention_mask')):
+        self.loader = iter(loader)
+        self.keys = keys
+        self.stream = torch.cuda.Stream() if device.type == 'cuda' else None
+        self.preload()
+
+    def preload(self):
+        try:
+            self.batch = next(self.loader)
+        except StopIteration:
+            self.batch = None
+            return
+        if self.stream is None:
+            for key in self.keys:
+                self.batch[key] = self.batch[key].to(device)
+            return
+        with torch.cuda.stream(self.stream):
+            for key in self.keys:
+                self.batch[key] = self.batch[key].to(device, non_blocking=True)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.batch
+        if batch is None:
+            raise StopIteration
+        if self.stream is not None:
+            # The tensors were allocated on the side stream but are consumed on the current one
+            for key in self.keys:
+                batch[key].record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch
+
+
 def compute_metric(
         conf: Config,
         model: AutoModelForSeq2SeqLM,
@@ -123,30 +229,50 @@ def compute_metric(
         tokenized_test: Dataset
 ):
     data_collator = DataCollatorForSeq2Seq(tokenizer, model=model, return_tensors="pt")
-    dataloader = torch.utils.data.DataLoader(tokenized_test, collate_fn=data_collator,
-                                             batch_size=conf.per_device_eval_batch_size)
+    # Batch length-sorted examples together so each batch pads only to its own longest input
+    order = np.argsort([len(input_ids) for input_ids in tokenized_test['input_ids']], kind='stable')
+    batch_sampler = [order[i:i + conf.per_device_test_batch_size].tolist()
+                     for i in range(0, len(order), conf.per_device_test_batch_size)]
+    num_workers = conf.num_proc // 2
+    dataloader = torch.utils.data.DataLoader(tokenized_test, collate_fn=data_collator, batch_sampler=batch_sampler,
+                                             pin_memory=device.type == 'cuda', num_workers=num_workers,
+                                             prefetch_factor=4 if num_workers > 0 else None)
+
+    # Greedy decoding is memory-bandwidth bound, so halve the weight and KV-cache bytes where bf16 is native.
+    if device.type == 'cuda' and torch.cuda.is_bf16_supported():
+        model = model.to(device, dtype=torch.bfloat16)
+    model.eval()
 
     predictions = []
     references = []
-    for _, batch in enumerate(tqdm(dataloader)):
-        outputs = model.generate(
-            input_ids=batch['input_ids'].to(device),
-            max_length=conf.tgt_len,
-            attention_mask=batch['attention_mask'].to(device)
-        )
-        with tokenizer.as_target_tokenizer():
-            outputs = [tokenizer.decode(out, clean_up_tokenization_spaces=False, skip_special_tokens=True) for out in
-                       outputs]
-            labels = np.where(batch['labels'] != -100, batch['labels'], tokenizer.pad_token_id)
-            actuals = [tokenizer.decode(out, clean_up_tokenization_spaces=False, skip_special_tokens=True) for out in
-                       labels]
-            predictions.extend(outputs)
-            references.extend(actuals)
+    for _, batch in enumerate(tqdm(DataPrefetcher(dataloader), total=len(dataloader))):
+        with torch.inference_mode():
+            outputs = model.generate(
+                input_ids=batch['input_ids'],
+                max_new_tokens=conf.tgt_len,
+                attention_mask=batch['attention_mask'],
+                use_cache=True,
+                num_beams=1,
+                do_sample=False
+            )
+        outputs = tokenizer.batch_decode(outputs, clean_up_tokenization_spaces=False, skip_special_tokens=True)
+        labels = batch['labels'].masked_fill(batch['labels'].eq(-100), tokenizer.pad_token_id)
+        actuals = tokenizer.batch_decode(labels, clean_up_tokenization_spaces=False, skip_special_tokens=True)
+        predictions.extend(outputs)
+        references.extend(actuals)
+
+    # Restore the original test-set order
+    unsorted_predictions = [None] * len(order)
+    unsorted_references = [None] * len(order)
+    for position, index in enumerate(order):
+        unsorted_predictions[index] = predictions[position]
+        unsorted_references[index] = references[position]
+    predictions, references = unsorted_predictions, unsorted_references
 
     # results = metrics.compute(predictions=predictions, references=references)
     logger.info('-----:----- Dumping results -----:-----')
-    with open(os.path.join(conf.checkpoint, 'results.json'), 'w', encoding='utf-8') as f:
-        json.dump({'predictions': predictions, 'references': references}, f, ensure_ascii=False, indent=2)
+    with open(os.path.join(conf.checkpoint, 'results.json'), 'wb') as f:
+        f.write(orjson.dumps({'predictions': predictions, 'references': references}, option=orjson.OPT_INDENT_2))
 
     return {'predictions': predictions, 'references': references}
 
@@ -160,8 +286,8 @@ def preprocess_and_train(
         test_set: Dataset
 ):
     def preprocess_function(examples):
-        inputs = tokenizer(examples["input_seq"], max_length=conf.src_len, truncation=True, padding=True)
-        labels = tokenizer(examples["output_seq"], max_length=conf.tgt_len, truncation=True, padding=True)
+        inputs = tokenizer(examples["input_seq"], max_length=conf.src_len, truncation=True)
+        labels = tokenizer(examples["output_seq"], max_length=conf.tgt_len, truncation=True)
         inputs['input_ids'] = inputs['input_ids']
 
         inputs['labels'] = labels['input_ids']
@@ -169,18 +295,31 @@ def preprocess_and_train(
         return inputs
 
     logger.info('-----:----- Tokenizing datasets -----:-----')
+    tok_key = (preprocess_function.__code__, conf.src_len, conf.tgt_len, conf.pretrained_model_name_or_path)
     tokenized_train = train_set.map(preprocess_function, batched=True, remove_columns=['input_seq', 'output_seq'],
-                                    num_proc=conf.num_proc)
+                                    num_proc=conf.num_proc,
+                                    cache_file_name=cache_file_name(conf, train_set, 'train_tok', tok_key),
+                                    load_from_cache_file=True)
     tokenized_val = val_set.map(preprocess_function, batched=True, remove_columns=['input_seq', 'output_seq'],
-                                num_proc=conf.num_proc)
+                                num_proc=conf.num_proc,
+                                cache_file_name=cache_file_name(conf, val_set, 'validation_tok', tok_key),
+                                load_from_cache_file=True)
     tokenized_test = test_set.map(preprocess_function, batched=True, remove_columns=['input_seq', 'output_seq'],
-                                  num_proc=conf.num_proc)
+                                  num_proc=conf.num_proc,
+                                  cache_file_name=cache_file_name(conf, test_set, 'test_tok', tok_key),
+                                  load_from_cache_file=True)
 
-    with open(os.path.join(conf.checkpoint, 'origin_refs.json'), 'w', encoding='utf-8') as f:
-        json.dump({'references': test_set['output_seq']}, f, ensure_ascii=False, indent=2)
+    with open(os.path.join(conf.checkpoint, 'origin_refs.json'), 'wb') as f:
+        f.write(orjson.dumps({'references': list(test_set['output_seq'])}, option=orjson.OPT_INDENT_2))
 
-    data_collator = DataCollatorForSeq2Seq(tokenizer, model=model, return_tensors="pt")
+    # Examples are kept variable-length; the collator pads each batch to its own max length
+    # (labels with -100) and group_by_length keeps similar lengths together.
+    data_collator = DataCollatorForSeq2Seq(tokenizer, model=model, pad_to_multiple_of=8, return_tensors="pt")
 
+    # bf16 and tf32 need Ampere or newer; older GPUs (e.g. Kaggle's P100/T4) train in fp32
+    bf16_supported = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+    # Inductor's Triton backend needs compute capability 7.0+, so a P100 (6.0) stays in eager mode
+    compile_supported = torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 7
     training_args = Seq2SeqTrainingArguments(
         output_dir=conf.checkpoint,
         do_train=True,
@@ -201,9 +340,17 @@ def preprocess_and_train(
         save_strategy="steps",
         save_steps=50,
         save_total_limit=1,
-        gradient_accumulation_steps=4,
+        gradient_accumulation_steps=1,
+        bf16=bf16_supported,
+        tf32=bf16_supported,
+        gradient_checkpointing=True,
+        gradient_checkpointing_kwargs={'use_reentrant': False},
+        optim='adamw_torch_fused' if torch.cuda.is_available() else 'adamw_torch',
+        dataloader_pin_memory=True,
+        dataloader_num_workers=conf.num_proc // 2,
         report_to='none',
-        label_names=['labels']
+        label_names=['labels'],
+        torch_compile=conf.torch_compile and compile_supported
     )
     trainer = Seq2SeqTrainer(
         model=model,
@@ -238,24 +385,31 @@ def main(model_name: str = 'vit5'):
         val_set=dev_dataset,
         test_set=test_dataset
     )
-    print(outputs[0])
-    with open(f'{conf.checkpoint}/results.json', 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    print(outputs['predictions'][0])
+
+    # Release the trained model (and the trainer's optimizer state) so BERTScore has the GPU to itself.
+    # Graphs cached by torch.compile hold the parameters too, so drop them before collecting.
+    del model
+    torch._dynamo.reset()
+    gc.collect()
+    torch.cuda.empty_cache()
+
+    with open(f'{conf.checkpoint}/results.json', 'rb') as f:
+        data = orjson.loads(f.read())
 
     pred = data['predictions']
     ref = data['references']
 
     bleu_score = bleu(pred, ref)
 
-    metrics = load_metric('rouge')
-    rouge_results = [{k: (v.mid.fmeasure) * 100} for k, v in metrics.compute(predictions=pred, references=ref).items()]
+    rouge_results = rouge(pred, ref)
 
+    ensure_wordnet()
     meteor_metrics = evaluate.load('meteor')
     meteor_results = meteor_metrics.compute(predictions=pred, references=ref)
 
-    bert_score = evaluate.load('bertscore')
-    bert_results = bert_score.compute(predictions=pred, references=ref, lang='vi')
-    bert_mean_f1 = np.array(bert_results['f1']).mean()
+    _, _, bert_f1 = bert_score.score(pred, ref, lang='vi', batch_size=128, device=device.type)
+    bert_mean_f1 = bert_f1.mean().item()
 
     results = {
         "bleu_score": bleu_score,
@@ -266,8 +420,11 @@ def main(model_name: str = 'vit5'):
 
     print(results)
 
-    with open(f'{conf.checkpoint}/scores.json', 'w', encoding='utf-8') as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
+    with open(f'{conf.checkpoint}/scores.json', 'wb') as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
 
 if __name__ == '__main__':
+  if sys.platform.startswith('linux'):
+    # Keep datasets' multiprocess workers on fork, the Linux default up to Python 3.13, on newer Pythons too
+    multiprocess.set_start_method('fork')
   main()
\ No newline at end of file